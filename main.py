@@ -1,8 +1,60 @@
-import datetime
+import hashlib
+import os
+import pickle
+import time
+from functools import lru_cache
 import pandas as pd
 import numpy as np
 from jqdata import *
 
+try:
+    from numpy.lib.stride_tricks import sliding_window_view
+except ImportError:  # numpy<1.20 没有 sliding_window_view，用 as_strided 构造一维只读窗口视图
+    from numpy.lib.stride_tricks import as_strided
+
+    def sliding_window_view(x, window_shape):
+        x = np.asarray(x)
+        step = x.strides[0]
+        return as_strided(x, shape=(x.shape[0] - window_shape + 1, window_shape),
+                          strides=(step, step), writeable=False)
+
+try:
+    import numba
+except ImportError:  # 未安装numba时退化为普通Python函数
+    numba = None
+
+def njit(*args, **kwargs):
+    """
+    numba.njit 的容错包装，用法相同
+    源码经 exec 加载时无法定位磁盘缓存、缓存过期等导致装饰失败时，先去掉 cache 重试，
+    仍失败则退化为普通Python函数，保证策略总能加载
+    """
+    if len(args) == 1 and callable(args[0]) and not kwargs:
+        return njit()(args[0])
+    
+    def decorate(func):
+        if numba is None:
+            return func
+        options = dict(kwargs)
+        try:
+            return numba.njit(*args, **options)(func)
+        except Exception as e:
+            if not options.pop('cache', False):
+                log.warning(f"numba编译失败 {func.__name__}，使用Python实现: {str(e)}")
+                return func
+            log.warning(f"numba缓存不可用 {func.__name__}，改为不缓存编译: {str(e)}")
+        try:
+            return numba.njit(*args, **options)(func)
+        except Exception as e:
+            log.warning(f"numba编译失败 {func.__name__}，使用Python实现: {str(e)}")
+            return func
+    return decorate
+
+try:
+    from joblib import Memory
+except ImportError:  # 未安装joblib时不做形态结果的持久化缓存
+    Memory = None
+
 # ==================== 全局配置 ====================
 def initialize(context):
     """
@@ -18,7 +70,12 @@ def initialize(context):
     # 全局变量
     g.stock_list = []           # 基础股票池
     g.candidate_stocks = []     # 候选股票
-    g.positions = {}            # 持仓信息
+    g.positions = {}            # 持仓信息（买入时间、卖出原因等）
+    # 持仓核心字段按列存储，与 g.positions 通过 add_position/remove_position 同步维护
+    g.codes = []                                  # 持仓代码
+    g.code_idx = {}                               # 代码 -> 数组下标
+    g.buy_prices = np.empty(0, dtype=np.float64)  # 买入价
+    g.selling = np.empty(0, dtype=np.bool_)       # 是否已标记卖出
     g.trading_enabled = True    # 交易开关
     
     # 参数设置 - 只修改风控部分
@@ -56,51 +113,133 @@ def initialize(context):
     run_daily(trade_logic, time='14:56')
     
     log.info("策略初始化完成 - 风控参数已优化")
+def after_code_changed(context):
+    """
+    模拟盘更新代码后调用：旧版本的持仓把买入价、卖出标记存在 g.positions 的字典里，
+    这里迁移为列数组存储，已有持仓不受影响
+    """
+    if hasattr(g, 'codes'):
+        return
+    
+    g.codes = []
+    g.code_idx = {}
+    g.buy_prices = np.empty(0, dtype=np.float64)
+    g.selling = np.empty(0, dtype=np.bool_)
+    legacy = g.positions
+    g.positions = {}
+    for stock_code, info in legacy.items():
+        buy_price = info.pop('buy_price')
+        selling = info.pop('selling', False)
+        add_position(stock_code, buy_price, **info)
+        g.selling[g.code_idx[stock_code]] = selling
+    
+    log.info("持仓存储已迁移: %d只", len(g.codes))
 # ==================== 股票池管理 ====================
 def initialize_stock_pool(context):
     """初始化基础股票池（每天更新）"""
     try:
         all_stocks = get_all_securities(types='stock', date=context.previous_date)
         current_data = get_current_data()
-        today = context.current_dt.date()
-        new_stock_threshold = datetime.timedelta(days=365)
-        
-        filtered_stocks = [
-            stock for stock in all_stocks.index
-            if (today - all_stocks.loc[stock, 'start_date']) > new_stock_threshold
-            and not current_data[stock].is_st
-            and not stock.startswith('BJ')
-            and not stock.startswith('68')
-            and not stock.startswith('3')
-        ]
-        
+        today = pd.Timestamp(context.current_dt.date())
+
+        # 向量化过滤：板块前缀 + 上市满一年
+        codes = all_stocks.index.astype(str)
+        listed_days = (today - pd.to_datetime(all_stocks['start_date'])).dt.days.values
+        mask = ~codes.str.startswith(('BJ', '68', '3')) & (listed_days > 365)
+
+        # ST 状态只能逐只读取，仅对通过前置过滤的股票查询
+        candidates = codes[mask]
+        st_flags = np.fromiter((current_data[s].is_st for s in candidates),
+                               dtype=bool, count=len(candidates))
+        filtered_stocks = candidates[~st_flags].tolist()
+
         q = query(valuation.code).filter(
-            valuation.market_cap < g.params['max_market_cap'], 
+            valuation.market_cap < g.params['max_market_cap'],
             valuation.code.in_(filtered_stocks)
         )
         df = get_fundamentals(q, date=context.previous_date)
-        
+
         if df.empty:
             g.stock_list = []
             return
-        
-        g.stock_list = []
-        for stock_code in df['code']:
-            stock_name = all_stocks.loc[stock_code, 'display_name']
-            g.stock_list.append((stock_code, stock_name))
-        
+
+        pool_codes = df['code'].values
+        g.stock_list = list(zip(pool_codes, all_stocks.loc[pool_codes, 'display_name'].values))
+
         log.info(f"股票池更新: {len(g.stock_list)}只股票")
         
     except Exception as e:
         log.error(f"初始化股票池失败: {str(e)}")
         g.stock_list = []
 
+# ==================== 磁盘缓存 ====================
+CACHE_DIR = '.cache'
+
+def _cache_path(namespace, key):
+    digest = hashlib.md5(key.encode('utf-8')).hexdigest()
+    return os.path.join(CACHE_DIR, namespace, digest + '.pkl')
+
+def cache_get(namespace, key, ttl_days):
+    """
+    读取磁盘缓存
+    返回：(是否命中, 缓存值)，文件不存在、损坏或超过 ttl_days 均视为未命中
+    """
+    try:
+        with open(_cache_path(namespace, key), 'rb') as f:
+            saved_at, value = pickle.load(f)
+    except (OSError, EOFError, ValueError, pickle.UnpicklingError):
+        return False, None
+    
+    if time.time() - saved_at > ttl_days * 86400:
+        return False, None
+    return True, value
+
+def cache_set(namespace, key, value):
+    """写入磁盘缓存（先写临时文件再替换，避免读到半截文件）"""
+    path = _cache_path(namespace, key)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            pickle.dump((time.time(), value), f)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        log.warning(f"写入缓存失败 {namespace}/{key}: {str(e)}")
+
+PATTERN_CACHE_VERSION = 3  # 形态识别逻辑变更时递增，使旧的磁盘缓存失效
+
+def pattern_cache(func):
+    return func
+
+if Memory is not None:
+    try:
+        pattern_cache = Memory(os.path.join(CACHE_DIR, 'patterns'), verbose=0).cache
+    except OSError as e:  # 缓存目录不可写或被同名文件占用时不做持久化，与 cache_set 一致
+        log.warning(f"形态缓存不可用: {str(e)}")
+
 # ==================== 股东户数变化因子  ====================
+SHAREHOLDER_CACHE_TTL_DAYS = 90
+_QUERY_FAILED = object()
+
 def get_shareholder_change(stock_code, current_date):
     """
     获取股东户数较上期的变化百分比
     返回：正数表示股东户数减少（筹码集中），负数表示增加，None表示数据不足
+    结果按(股票, 日期)缓存到磁盘，重复回测时不再查询
     """
+    cache_key = f"{stock_code}|{current_date}"
+    hit, cached = cache_get('shareholder', cache_key, SHAREHOLDER_CACHE_TTL_DAYS)
+    if hit:
+        return cached
+    
+    change_pct = _query_shareholder_change(stock_code, current_date)
+    if change_pct is not _QUERY_FAILED:
+        cache_set('shareholder', cache_key, change_pct)
+        return change_pct
+    return None
+
+def _query_shareholder_change(stock_code, current_date):
+    """查询股东户数变化，查询异常时返回 _QUERY_FAILED（不写入缓存）"""
     try:
         q = query(
             finance.STK_HOLDER_NUM.code,
@@ -128,15 +267,27 @@ def get_shareholder_change(stock_code, current_date):
             return None
     except Exception as e:
         log.error(f"获取股东户数变化失败 {stock_code}: {str(e)}")
-        return None
+        return _QUERY_FAILED
 
 # ==================== 形态识别模块  ====================
-def identify_A_kill(stock_code, end_date):
+@lru_cache(maxsize=256)
+def load_daily_bars(stock_code, end_date):
+    """
+    获取最近200日日线数据，按(股票, 日期)缓存
+    返回的DataFrame在多个识别函数间共享，调用方不得修改
+    """
+    return get_price(
+        stock_code,
+        end_date=end_date,
+        count=200,
+        frequency='daily',
+        fields=['open', 'close', 'high', 'low', 'volume']
+    )
+
+
+def identify_A_kill(price_data):
     """放宽版的A杀识别"""
     try:
-        price_data = get_price(stock_code, end_date=end_date, count=200, 
-                             fields=['close', 'high', 'low'])
-        
         if len(price_data) < 60:
             return {'has_A_kill': True}
         
@@ -162,142 +313,145 @@ def identify_A_kill(stock_code, end_date):
         return {'has_A_kill': True}
 
 
-def identify_three_waves(stock_code, start_date, end_date):
+def local_extrema(closes, half_window=3):
+    """
+    标记局部高/低点：收盘价为前后 half_window 日内的最高/最低
+    两端不足一个完整窗口的位置均为False
+    """
+    n = len(closes)
+    is_high = np.zeros(n, dtype=np.bool_)
+    is_low = np.zeros(n, dtype=np.bool_)
+    if n > 2 * half_window:
+        windows = sliding_window_view(closes, 2 * half_window + 1)
+        center = closes[half_window:n - half_window]
+        is_high[half_window:n - half_window] = windows.max(axis=1) == center
+        is_low[half_window:n - half_window] = windows.min(axis=1) == center
+    return is_high, is_low
+
+
+WAVE_MIN_RISE_PCT = 10.0   # 拉升波最小涨幅
+WAVE_MIN_FALL_PCT = -5.0   # 回调波最小跌幅
+
+
+# 显式签名：导入时即完成编译，回测开始后不再有首次调用的编译延迟
+# 不使用磁盘缓存：源码经 exec 加载时无法定位缓存，残留的旧缓存也会导致导入失败
+@njit('Tuple((i8[:], i8[:], f8[:]))(f8[:], f8[:], f8[:], f8[:], b1[:], b1[:], f8, f8)')
+def _scan_waves(closes, opens, lows, volumes, is_high, is_low, min_rise, min_fall):
+    """
+    波段扫描内核（numba编译）
+    从拉升波开始交替扫描，最多8个波段；is_high/is_low 为预先计算的局部高/低点标记
+    返回：波段起点索引、终点索引、支撑位（无支撑位为NaN）
+    """
+    n = len(closes)
+    max_waves = 8
+    starts = np.empty(max_waves, dtype=np.int64)
+    ends = np.empty(max_waves, dtype=np.int64)
+    supports = np.full(max_waves, np.nan)
+
+    count = 0
+    current_idx = 0
+    is_up = True
+
+    while current_idx < n - 10 and count < max_waves:
+        # 寻找波段起点：拉升波找低点，回调波找高点
+        window = closes[current_idx:min(current_idx + 10, n)]
+        if is_up:
+            start_idx = current_idx + np.argmin(window)
+        else:
+            start_idx = current_idx + np.argmax(window)
+        start_price = closes[start_idx]
+
+        # 寻找波段终点：达到幅度要求的局部极值
+        end_idx = -1
+        for i in range(start_idx + 5, min(start_idx + 30, n - 3)):
+            if is_up:
+                if is_high[i] and (closes[i] - start_price) / start_price * 100 >= min_rise:
+                    end_idx = i
+                    break
+            else:
+                if is_low[i] and (closes[i] - start_price) / start_price * 100 <= min_fall:
+                    end_idx = i
+                    break
+
+        if end_idx < 0:
+            # 没找到合适的终点，使用最大允许天数
+            end_idx = min(start_idx + 29, n - 1)
+
+        # 记录支撑位（拉升波中的放量阳线低点）
+        if is_up:
+            wave_opens = opens[start_idx:end_idx + 1]
+            wave_closes = closes[start_idx:end_idx + 1]
+            wave_lows = lows[start_idx:end_idx + 1]
+            wave_volumes = volumes[start_idx:end_idx + 1]
+            mask = (wave_closes > wave_opens) & (wave_volumes > wave_volumes.mean() * 1.2)
+            if mask.any():
+                supports[count] = wave_lows[mask].min()
+
+        starts[count] = start_idx
+        ends[count] = end_idx
+        count += 1
+
+        # 准备下一个波段
+        current_idx = end_idx + 1
+        is_up = not is_up
+
+    return starts[:count], ends[:count], supports[:count]
+
+
+def identify_three_waves(price_data, start_date, min_wave_score):
     """
     识别三波拉升形态
+    price_data: 日线数据（open/close/high/low/volume），需覆盖 start_date 之后的走势
+    min_wave_score: 确认形态所需的最低质量分
     """
     try:
-        # 获取数据
-        days_needed = (end_date - start_date).days + 100
-        price_data = get_price(
-            stock_code,
-            end_date=end_date,
-            count=days_needed,
-            frequency='daily',
-            fields=['open', 'close', 'high', 'low', 'volume']
-        )
-        
         if price_data is None:
             return {'confirmed': False, 'reason': '数据获取失败'}
         
         # 找到起始位置
-        price_data.index = pd.to_datetime(price_data.index)
-        start_idx = None
-        for i, date in enumerate(price_data.index):
-            if date.date() >= start_date:
-                start_idx = i
-                break
-        
-        if start_idx is None or len(price_data) - start_idx < 30:
+        dates = price_data.index
+        if not isinstance(dates, pd.DatetimeIndex):
+            dates = pd.to_datetime(dates)
+        start_idx = dates.searchsorted(pd.Timestamp(start_date))
+        
+        if len(price_data) - start_idx < 30:
             return {'confirmed': False, 'reason': '数据长度不足'}
         
-        data = price_data.iloc[start_idx:].copy()
-        closes = data['close'].values
+        data = price_data.iloc[start_idx:]
+        wave_dates = dates[start_idx:]
+        closes = data['close'].values.astype(np.float64)
+        opens = data['open'].values.astype(np.float64)
+        lows = data['low'].values.astype(np.float64)
+        volumes = data['volume'].values.astype(np.float64)
         
         # 寻找波段
+        is_high, is_low = local_extrema(closes)
+        starts, ends, supports = _scan_waves(closes, opens, lows, volumes, is_high, is_low,
+                                             WAVE_MIN_RISE_PCT, WAVE_MIN_FALL_PCT)
+        
         waves = []
         support_levels = []
-        current_idx = 0
-        wave_type = 'up'
-        
-        while current_idx < len(data) - 10 and len(waves) < 8:
-            # 寻找波段起点
-            if wave_type == 'up':
-                # 寻找低点
-                best_low_idx = current_idx
-                best_low = closes[current_idx]
-                
-                for i in range(current_idx, min(current_idx + 10, len(data))):
-                    if closes[i] < best_low:
-                        best_low = closes[i]
-                        best_low_idx = i
-                
-                start_idx = best_low_idx
-                start_price = best_low
-            
-            else:  # down
-                # 寻找高点
-                best_high_idx = current_idx
-                best_high = closes[current_idx]
-                
-                for i in range(current_idx, min(current_idx + 10, len(data))):
-                    if closes[i] > best_high:
-                        best_high = closes[i]
-                        best_high_idx = i
-                
-                start_idx = best_high_idx
-                start_price = best_high
-            
-            # 寻找波段终点
-            end_idx = None
-            end_price = None
-            
-            for i in range(start_idx + 5, min(start_idx + 30, len(data))):
-                current_price = closes[i]
-                
-                if wave_type == 'up':
-                    current_rise = (current_price - start_price) / start_price * 100
-                    if current_rise >= 10:  # 达到最小涨幅
-                        # 检查是否是局部高点
-                        if i < len(data) - 3:
-                            if (current_price >= max(closes[max(0, i-3):i+1]) and 
-                                current_price >= max(closes[i+1:min(len(data), i+4)])):
-                                end_idx = i
-                                end_price = current_price
-                                break
-                
-                else:  # down
-                    current_fall = (current_price - start_price) / start_price * 100
-                    if current_fall <= -5:  # 回调达到5%
-                        # 检查是否是局部低点
-                        if i < len(data) - 3:
-                            if (current_price <= min(closes[max(0, i-3):i+1]) and 
-                                current_price <= min(closes[i+1:min(len(data), i+4)])):
-                                end_idx = i
-                                end_price = current_price
-                                break
-            
-            if end_idx is None:
-                # 没找到合适的终点，使用最大允许天数
-                end_idx = min(start_idx + 29, len(data) - 1)
-                end_price = closes[end_idx]
-            
-            # 计算波段特征
+        for k in range(len(starts)):
+            wave_start, wave_end = int(starts[k]), int(ends[k])
+            start_price = closes[wave_start]
+            end_price = closes[wave_end]
             change_pct = (end_price - start_price) / start_price * 100
+            support_level = None if np.isnan(supports[k]) else float(supports[k])
             
-            # 记录支撑位（拉升波中的放量阳线低点）
-            support_level = None
-            if wave_type == 'up':
-                wave_data = data.iloc[start_idx:end_idx+1]
-                volumes = wave_data['volume'].values
-                avg_volume = np.mean(volumes) if len(volumes) > 0 else 0
-                
-                for i in range(len(wave_data)):
-                    idx = start_idx + i
-                    if (data.iloc[i]['close'] > data.iloc[i]['open'] and 
-                        volumes[i] > avg_volume * 1.2):
-                        current_low = data.iloc[i]['low']
-                        if support_level is None or current_low < support_level:
-                            support_level = current_low
-                
-                if support_level:
-                    support_levels.append(float(support_level))
+            if support_level:
+                support_levels.append(support_level)
             
-            # 记录波段
+            # 记录波段（从拉升波开始交替）
             waves.append({
-                'wave_type': wave_type,
-                'start_date': data.index[start_idx],
-                'end_date': data.index[end_idx],
+                'wave_type': 'up' if k % 2 == 0 else 'down',
+                'start_date': wave_dates[wave_start],
+                'end_date': wave_dates[wave_end],
                 'start_price': float(start_price),
                 'end_price': float(end_price),
                 'change_pct': float(change_pct),
-                'duration': end_idx - start_idx + 1,
-                'support_level': float(support_level) if support_level else None
+                'duration': wave_end - wave_start + 1,
+                'support_level': support_level
             })
-            
-            # 准备下一个波段
-            current_idx = end_idx + 1
-            wave_type = 'down' if wave_type == 'up' else 'up'
         
         # 分析结果
         up_waves = [w for w in waves if w['wave_type'] == 'up']
@@ -329,7 +483,7 @@ def identify_three_waves(stock_code, start_date, end_date):
         if len(support_levels) >= 2:
             score += 20
         
-        if score < g.params['min_wave_score']:
+        if score < min_wave_score:
             return {'confirmed': False, 'reason': f'质量分不足: {score:.1f}'}
         
         # 计算总涨幅
@@ -352,21 +506,59 @@ def identify_three_waves(stock_code, start_date, end_date):
     except Exception as e:
         return {'confirmed': False, 'reason': f'识别失败: {str(e)}'}
 
+@pattern_cache
+def detect_patterns(stock_code, end_date, min_wave_score, version=PATTERN_CACHE_VERSION):
+    """
+    A杀 + 三波拉升 + 洗盘识别，并取出信号判断所需的当日行情
+    全部只依赖 end_date 及之前的行情，结果按(股票, 日期, 参数, 版本)持久化缓存，命中时不再获取日线
+    返回：形态全部成立时为 dict，否则为 None
+    """
+    bars = load_daily_bars(stock_code, end_date)
+    if bars is None or bars.empty:
+        return None
+    
+    # 数据不足60日时只有 has_A_kill 标记、没有A杀底部日期，无法继续识别
+    a_kill = identify_A_kill(bars)
+    if not a_kill['has_A_kill'] or 'A_bottom_date' not in a_kill:
+        return None
+    
+    three_waves = identify_three_waves(bars, a_kill['A_bottom_date'].date(), min_wave_score)
+    if not three_waves['confirmed']:
+        return None
+    
+    consolidation = check_consolidation(
+        bars.iloc[-60:],
+        three_waves['wave3_high'],
+        three_waves['support_levels']
+    )
+    if not consolidation or not consolidation['is_consolidating']:
+        return None
+    
+    # 当天数据（直接读取各列末尾元素，不复制整张表）
+    last = len(bars) - 1
+    today_open, today_close, today_high, today_volume = (
+        bars[col].values[last] for col in ('open', 'close', 'high', 'volume')
+    )
+    recent_volumes = bars['volume'].values[-5:]
+    avg_volume_5 = recent_volumes.mean() if len(recent_volumes) >= 5 else today_volume
+    
+    return {
+        'three_waves': three_waves,
+        'consolidation': consolidation,
+        'today_open': today_open,
+        'today_close': today_close,
+        'today_high': today_high,
+        'today_volume': today_volume,
+        'avg_volume_5': avg_volume_5
+    }
+
 # ==================== 洗盘阶段检测 ====================
-def check_consolidation(stock_code, wave3_high, support_levels, end_date):
+def check_consolidation(price_data, wave3_high, support_levels):
     """
     检查是否处于洗盘阶段
+    price_data: 最近60日日线数据（close/volume）
     """
     try:
-        # 获取最近60日数据
-        price_data = get_price(
-            stock_code,
-            end_date=end_date,
-            count=60,
-            frequency='daily',
-            fields=['close', 'volume']
-        )
-        
         if price_data is None or len(price_data) < 20:
             return None
         
@@ -378,18 +570,15 @@ def check_consolidation(stock_code, wave3_high, support_levels, end_date):
         strongest_support = max(support_levels)
         
         # 检查价格区间
-        in_range_count = 0
-        for price in closes:
-            if strongest_support * 0.98 <= price <= wave3_high * 1.02:
-                in_range_count += 1
-        
+        in_range_count = np.count_nonzero(
+            (closes >= strongest_support * 0.98) & (closes <= wave3_high * 1.02)
+        )
         in_range_ratio = in_range_count / len(closes)
         
         # 检查成交量
         volumes = price_data['volume'].values
         if len(volumes) >= 20:
-            recent_vol = np.mean(volumes[-10:])
-            early_vol = np.mean(volumes[:10])
+            recent_vol, early_vol = volumes[-10:].mean(), volumes[:10].mean()
             volume_ratio = recent_vol / early_vol if early_vol > 0 else 1
         else:
             volume_ratio = 1
@@ -418,46 +607,16 @@ def generate_trade_signal(stock_code, stock_name, price_change, turnover_ratio,
     try:
         current_date = context.current_dt.date()
         
-        # 1. 检查A杀 
-        a_kill = identify_A_kill(stock_code, current_date)
-        if not a_kill['has_A_kill']:
-            return None
-        
-        # 2. 检查三波拉升
-        three_waves = identify_three_waves(
-            stock_code,
-            a_kill['A_bottom_date'].date(),
-            current_date
-        )
-        
-        if not three_waves['confirmed']:
-            return None
-        
-        # 3. 检查洗盘阶段
-        consolidation = check_consolidation(
-            stock_code,
-            three_waves['wave3_high'],
-            three_waves['support_levels'],
-            current_date
-        )
-        
-        if not consolidation or not consolidation['is_consolidating']:
+        # 1-4. A杀、三波拉升、洗盘识别及当天数据（整体按日缓存）
+        patterns = detect_patterns(stock_code, current_date, g.params['min_wave_score'])
+        if not patterns:
             return None
         
-        # 4. 获取当天数据
-        today_data = get_price(
-            stock_code,
-            end_date=current_date,
-            count=1,
-            frequency='daily',
-            fields=['open', 'close', 'high', 'low', 'volume']
-        )
-        
-        if today_data is None or today_data.empty:
-            return None
-        
-        today_close = today_data['close'].iloc[0]
-        today_high = today_data['high'].iloc[0]
+        three_waves = patterns['three_waves']
+        consolidation = patterns['consolidation']
+        today_open, today_close, today_high = \
+            patterns['today_open'], patterns['today_close'], patterns['today_high']
+        today_volume, avg_volume_5 = patterns['today_volume'], patterns['avg_volume_5']
         
         # 5. 获取股东户数变化 (新增)
         shareholder_change = get_shareholder_change(stock_code, current_date)
@@ -466,17 +625,9 @@ def generate_trade_signal(stock_code, stock_name, price_change, turnover_ratio,
         resistance = three_waves['wave3_high']
         breakthrough = today_close > resistance
         early_break = (today_high > resistance * 1.01 and 
-                      today_close > today_data['open'].iloc[0] * 1.02)
+                      today_close > today_open * 1.02)
         
-        avg_volume_5 = get_price(
-            stock_code,
-            end_date=current_date,
-            count=5,
-            frequency='daily',
-            fields=['volume']
-        )['volume'].mean() if len(get_price(stock_code, end_date=current_date, count=5, frequency='daily')) >= 5 else today_data['volume'].iloc[0]
-        
-        volume_ratio = today_data['volume'].iloc[0] / avg_volume_5 if avg_volume_5 > 0 else 1
+        volume_ratio = today_volume / avg_volume_5 if avg_volume_5 > 0 else 1
         
         # 7. 信号强度判断
         signal_strength = 'weak'
@@ -517,80 +668,137 @@ def generate_trade_signal(stock_code, stock_name, price_change, turnover_ratio,
         return None    
 
 # ==================== 持仓管理 (按新规则拆分和修改) ====================
-def check_immediate_stops(context):
+# 以当日分钟数(hour*60+minute)表示的时段边界
+OPEN_CUTOFF = 9 * 60 + 30    # 09:30 之前为开盘集合竞价
+CLOSE_CUTOFF = 14 * 60 + 55  # 14:55 之后交给尾盘专门函数
+
+def add_position(stock_code, buy_price, **info):
+    """登记新持仓：买入价和卖出标记追加到列数组末尾，其余信息存入 g.positions"""
+    g.code_idx[stock_code] = len(g.codes)
+    g.codes.append(stock_code)
+    g.buy_prices = np.append(g.buy_prices, buy_price)
+    g.selling = np.append(g.selling, False)
+    g.positions[stock_code] = info
+
+def mark_selling(stock_code, reason, sell_time):
+    """标记持仓为卖出中"""
+    g.selling[g.code_idx[stock_code]] = True
+    position = g.positions[stock_code]
+    position['sell_reason'] = reason
+    position['sell_time'] = sell_time
+
+def remove_position(stock_code):
+    """移除持仓：末尾元素换到被删位置，数组保持紧凑"""
+    idx = g.code_idx.pop(stock_code)
+    last = len(g.codes) - 1
+    if idx != last:
+        last_code = g.codes[last]
+        g.codes[idx] = last_code
+        g.buy_prices[idx] = g.buy_prices[last]
+        g.selling[idx] = g.selling[last]
+        g.code_idx[last_code] = idx
+    g.codes.pop()
+    g.buy_prices = g.buy_prices[:last]
+    g.selling = g.selling[:last]
+    del g.positions[stock_code]
+
+def active_position_codes(context):
+    """未标记卖出且账户中实际有持仓的股票代码"""
+    codes = []
+    for stock_code, selling in zip(g.codes, g.selling):
+        if selling:
+            continue
+        if stock_code not in context.portfolio.positions:
+            continue
+        if context.portfolio.positions[stock_code].total_amount <= 0:
+            continue
+        codes.append(stock_code)
+    return codes
+
+def position_profit_arrays(codes, current_data=None):
+    """
+    批量计算持仓盈亏（结构数组化：买入价、现价各一个float64数组）
+    current_data: 行情快照，未传入时调用 get_current_data()
+    返回：(买入价数组, 现价数组, 盈亏百分比数组)
+    读取行情失败的股票现价和盈亏记为NaN，条件比较结果为False，不会触发任何操作
+    """
+    if current_data is None:
+        current_data = get_current_data()
+    buy_prices = g.buy_prices[[g.code_idx[c] for c in codes]]
+    current_prices = np.full(len(codes), np.nan)
+    for i, stock_code in enumerate(codes):
+        try:
+            current_prices[i] = current_data[stock_code].last_price
+        except Exception as e:
+            log.error("读取现价失败 %s: %s", stock_code, e)
+    profit_pcts = (current_prices - buy_prices) / buy_prices * 100
+    return buy_prices, current_prices, profit_pcts
+
+def position_hold_days(codes, current_date):
+    """
+    批量计算持有天数
+    买入时间缺失或无效的股票记为-1，不会触发时间止损
+    """
+    hold_days = np.full(len(codes), -1, dtype=np.int64)
+    for i, stock_code in enumerate(codes):
+        try:
+            hold_days[i] = (current_date - g.positions[stock_code]['buy_time'].date()).days
+        except Exception as e:
+            log.error("尾盘检查错误 %s: %s", stock_code, e)
+    return hold_days
+
+def check_immediate_stops(context, current_data):
     """
     立即止损止盈检查 - 使用优化后的参数
-    每分钟由 handle_data 调用
+    每分钟由 handle_data 调用，current_data 为本分钟的行情快照（只读）
     """
     if not g.positions:
         return
     
-    current_time = context.current_dt.time()
+    dt = context.current_dt
+    minute_of_day = dt.hour * 60 + dt.minute
     
     # 避开特殊时段
-    if current_time.hour == 9 and current_time.minute < 30:
+    if minute_of_day < OPEN_CUTOFF or minute_of_day >= CLOSE_CUTOFF:
         return
-    if current_time.hour == 14 and current_time.minute >= 55:
+    
+    codes = active_position_codes(context)
+    if not codes:
         return
     
-    for stock_code, position in list(g.positions.items()):
+    buy_prices, current_prices, profit_pcts = position_profit_arrays(codes, current_data)
+    
+    # =========== 使用新参数的条件判断 ===========
+    # 1. 立即止损：亏损达到-5%
+    stop_mask = profit_pcts <= -g.params['immediate_stop_loss'] * 100
+    # 2. 立即止盈：盈利达到12%（止损优先）
+    take_mask = ~stop_mask & (profit_pcts >= g.params['immediate_take_profit'] * 100)
+    # ======================================
+    
+    for i in np.flatnonzero(stop_mask | take_mask):
+        stock_code = codes[i]
+        buy_price, current_price, profit_pct = buy_prices[i], current_prices[i], profit_pcts[i]
         try:
-            # 跳过已标记卖出的持仓
-            if position.get('selling', False):
-                continue
-            
-            # 检查实际持仓
-            if stock_code not in context.portfolio.positions:
-                continue
-            
-            current_amount = context.portfolio.positions[stock_code].total_amount
-            if current_amount <= 0:
-                continue
-            
-            # 获取当前价格
-            current_data = get_current_data()[stock_code]
-            current_price = current_data.last_price
+            if stop_mask[i]:
+                log.info("🚨 立即止损触发: %s", stock_code)
+                log.info("   买入价: %.2f, 当前价: %.2f, 亏损: %.1f%%", buy_price, current_price, profit_pct)
+                sell_reason = f"立即止损({profit_pct:.1f}%)"
+            else:
+                log.info("🎯 立即止盈触发: %s", stock_code)
+                log.info("   买入价: %.2f, 当前价: %.2f, 盈利: %.1f%%", buy_price, current_price, profit_pct)
+                sell_reason = f"立即止盈({profit_pct:.1f}%)"
             
-            buy_price = position['buy_price']
-            profit_pct = (current_price - buy_price) / buy_price * 100
+            # 市价卖出
+            order_target(stock_code, 0)
             
-            # =========== 使用新参数的条件判断 ===========
-            # 1. 立即止损：亏损达到-5%
-            if profit_pct <= -g.params['immediate_stop_loss'] * 100:
-                log.info(f"🚨 立即止损触发: {stock_code}")
-                log.info(f"   买入价: {buy_price:.2f}, 当前价: {current_price:.2f}, 亏损: {profit_pct:.1f}%")
-                
-                # 市价卖出
-                order_target(stock_code, 0)
-                
-                # 更新状态
-                g.positions[stock_code]['selling'] = True
-                g.positions[stock_code]['sell_reason'] = f"立即止损({profit_pct:.1f}%)"
-                g.positions[stock_code]['sell_time'] = context.current_dt
-                
-                # 记录资金释放
-                log.info(f"   资金已释放，当前可用: {context.portfolio.available_cash:.2f}")
-                continue
+            # 更新状态
+            mark_selling(stock_code, sell_reason, context.current_dt)
             
-            # 2. 立即止盈：盈利达到12%
-            if profit_pct >= g.params['immediate_take_profit'] * 100:
-                log.info(f"🎯 立即止盈触发: {stock_code}")
-                log.info(f"   买入价: {buy_price:.2f}, 当前价: {current_price:.2f}, 盈利: {profit_pct:.1f}%")
-                
-                # 市价卖出
-                order_target(stock_code, 0)
-                
-                # 更新状态
-                g.positions[stock_code]['selling'] = True
-                g.positions[stock_code]['sell_reason'] = f"立即止盈({profit_pct:.1f}%)"
-                g.positions[stock_code]['sell_time'] = context.current_dt
-                
-                # 记录资金释放
-                log.info(f"   资金已释放，当前可用: {context.portfolio.available_cash:.2f}")
-                # ======================================
+            # 记录资金释放
+            log.info("   资金已释放，当前可用: %.2f", context.portfolio.available_cash)
                 
         except Exception as e:
-            log.error(f"立即止损止盈检查错误 {stock_code}: {str(e)}")
+            log.error("立即止损止盈检查错误 %s: %s", stock_code, e)
             
 def check_tail_position(context):
     """
@@ -605,47 +813,29 @@ def check_tail_position(context):
     log.info(f"=== 14:55尾盘持仓检查（新参数） ===")
     log.info(f"当前可用资金: {context.portfolio.available_cash:.2f}")
     
-    for stock_code, position in list(g.positions.items()):
-        try:
-            # 跳过已标记卖出的持仓
-            if position.get('selling', False):
-                continue
-            
-            # 检查实际持仓
-            if stock_code not in context.portfolio.positions:
-                continue
-            
-            current_amount = context.portfolio.positions[stock_code].total_amount
-            if current_amount <= 0:
-                continue
-            
-            # 获取当前价格
-            current_data = get_current_data()[stock_code]
-            current_price = current_data.last_price
-            
-            buy_price = position['buy_price']
-            profit_pct = (current_price - buy_price) / buy_price * 100
-            hold_days = (current_date - position['buy_time'].date()).days
-            
-            # =========== 使用新参数的条件判断 ===========
-            should_sell = False
-            reason = ""
-            
-            # 1. 尾盘止盈：盈利达到6%
-            if profit_pct >= g.params['tail_take_profit'] * 100:
-                should_sell = True
-                reason = f"尾盘止盈({profit_pct:.1f}%)"
-            
-            # 2. 时间止损：持有4天
-            elif hold_days >= g.params['time_stop_days']:
-                should_sell = True
-                if profit_pct > 0:
-                    reason = f"时间止盈({hold_days}天, 盈利{profit_pct:.1f}%)"
+    codes = active_position_codes(context)
+    if codes:
+        buy_prices, current_prices, profit_pcts = position_profit_arrays(codes)
+        hold_days = position_hold_days(codes, current_date)
+        
+        # =========== 使用新参数的条件判断 ===========
+        # 1. 尾盘止盈：盈利达到6%
+        take_mask = profit_pcts >= g.params['tail_take_profit'] * 100
+        # 2. 时间止损：持有4天
+        time_mask = ~take_mask & (hold_days >= g.params['time_stop_days']) & ~np.isnan(profit_pcts)
+        # ======================================
+        
+        for i in np.flatnonzero(take_mask | time_mask):
+            stock_code = codes[i]
+            buy_price, current_price, profit_pct = buy_prices[i], current_prices[i], profit_pcts[i]
+            try:
+                if take_mask[i]:
+                    reason = f"尾盘止盈({profit_pct:.1f}%)"
+                elif profit_pct > 0:
+                    reason = f"时间止盈({hold_days[i]}天, 盈利{profit_pct:.1f}%)"
                 else:
-                    reason = f"时间止损({hold_days}天, 亏损{profit_pct:.1f}%)"
-            # ======================================
-            
-            if should_sell:
+                    reason = f"时间止损({hold_days[i]}天, 亏损{profit_pct:.1f}%)"
+                
                 log.info(f"尾盘卖出: {stock_code} - {reason}")
                 log.info(f"  买入价: {buy_price:.2f}, 当前价: {current_price:.2f}, 盈亏: {profit_pct:.1f}%")
                 
@@ -653,31 +843,31 @@ def check_tail_position(context):
                 order_target(stock_code, 0)
                 
                 # 标记状态
-                g.positions[stock_code]['selling'] = True
-                g.positions[stock_code]['sell_reason'] = reason
-                g.positions[stock_code]['sell_time'] = context.current_dt
+                mark_selling(stock_code, reason, context.current_dt)
                 
-        except Exception as e:
-            log.error(f"尾盘检查错误 {stock_code}: {str(e)}")
+            except Exception as e:
+                log.error(f"尾盘检查错误 {stock_code}: {str(e)}")
     
     # 清理已卖出的持仓记录
     cleanup_sold_positions(context)
     log.info(f"尾盘检查后可用资金: {context.portfolio.available_cash:.2f}")
 
 def cleanup_sold_positions(context):
-    """清理已卖出的持仓记录"""
-    stocks_to_remove = []
-    for stock_code, position in list(g.positions.items()):
-        if position.get('selling', False):
-            current_amount = 0
-            if stock_code in context.portfolio.positions:
-                current_amount = context.portfolio.positions[stock_code].total_amount
-            if current_amount <= 0:
-                stocks_to_remove.append(stock_code)
-    
-    for stock_code in stocks_to_remove:
-        if stock_code in g.positions:
-            del g.positions[stock_code]
+    """清理已卖出的持仓记录（只检查已标记卖出的股票）"""
+    if not g.selling.any():
+        return
+    
+    sold = []
+    for i in np.flatnonzero(g.selling):
+        stock_code = g.codes[i]
+        current_amount = 0
+        if stock_code in context.portfolio.positions:
+            current_amount = context.portfolio.positions[stock_code].total_amount
+        if current_amount <= 0:
+            sold.append(stock_code)
+    
+    for stock_code in sold:
+        remove_position(stock_code)
 
 # ==================== 交易逻辑  ====================
 def trade_logic(context):
@@ -695,7 +885,7 @@ def trade_logic(context):
     log.info(f"交易日期: {context.current_dt.date()} 14:56")
     log.info(f"当前可用资金: {context.portfolio.available_cash:.2f}")
     
-    current_positions = len([p for p in context.portfolio.positions.values() if p.total_amount > 0])
+    current_positions = sum(1 for p in context.portfolio.positions.values() if p.total_amount > 0)
     if current_positions >= g.params['max_positions']:
         log.info(f"已达最大持仓{current_positions}只，不再买入")
         return
@@ -712,46 +902,10 @@ def trade_logic(context):
         return
     
     current_date = context.current_dt.date()
-    prev_date = get_trade_days(end_date=current_date, count=2)[0] if len(get_trade_days(end_date=current_date, count=2)) >= 2 else current_date
+    prev_date = prev_trade_day(current_date) or current_date
     
     # 基础筛选 (涨幅>5%，换手5%-20%)
-    basic_candidates = []
-    for stock_code, stock_name in g.stock_list:
-        try:
-            price_data = get_price(stock_code, end_date=current_date, count=2,
-                                 fields=['close', 'high', 'volume', 'low'])
-            if price_data.empty or len(price_data) < 2:
-                continue
-                
-            pre_close = price_data['close'].iloc[0]
-            today_high = price_data['high'].iloc[1]
-            today_volume = price_data['volume'].iloc[1]
-            
-            price_change = (today_high - pre_close) / pre_close * 100
-            
-            circ_df = get_fundamentals(
-                query(valuation.circulating_cap).filter(valuation.code == stock_code),
-                date=prev_date
-            )
-            if circ_df.empty:
-                continue
-            
-            circulating_shares = circ_df['circulating_cap'].iloc[0] * 10000
-            turnover_ratio = (today_volume / circulating_shares) * 100
-            
-            if (g.params['min_turnover'] < turnover_ratio <= g.params['max_turnover'] and 
-                price_change > g.params['min_price_change'] and 
-                not is_close_limit_up(stock_code, current_date)):
-                basic_candidates.append({
-                    'code': stock_code,
-                    'name': stock_name,
-                    'price_change': price_change,
-                    'turnover_ratio': turnover_ratio
-                })
-                    
-        except Exception as e:
-            continue
-    
+    basic_candidates = screen_basic_candidates(current_date, prev_date)
     log.info(f"基础筛选通过: {len(basic_candidates)}只")
     
     # 生成交易信号 (集成形态和股东户数)
@@ -792,6 +946,7 @@ def trade_logic(context):
     # 买入评分最高的股票
     buy_count = 0
     max_buy = min(2, g.params['max_positions'] - current_positions)
+    current_data = get_current_data()
     
     for signal in trade_signals[:max_buy * 2]:
         if buy_count >= max_buy:
@@ -802,7 +957,7 @@ def trade_logic(context):
             continue
         
         try:
-            current_price = get_current_data()[stock_code].last_price
+            current_price = current_data[stock_code].last_price
             log.info(f"买入 [{buy_count+1}]: {signal['stock_name']} ({stock_code})")
             log.info(f"  综合评分: {calculate_composite_score(signal):.1f} | 涨幅: {signal['price_change']:.1f}% | 换手: {signal['turnover_ratio']:.1f}%")
             if signal.get('shareholder_change') is not None:
@@ -811,14 +966,14 @@ def trade_logic(context):
             order_result = order_value(stock_code, position_value)
             
             if order_result:
-                g.positions[stock_code] = {
-                    'buy_price': current_price,
-                    'buy_time': context.current_dt,
-                    'quantity': position_value / current_price if current_price > 0 else 0,
-                    'selling': False,
-                    'stop_loss': current_price * 0.97,   # 3%止损
-                    'take_profit': current_price * 1.08  # 8%止盈
-                }
+                add_position(
+                    stock_code,
+                    current_price,
+                    buy_time=context.current_dt,
+                    quantity=position_value / current_price if current_price > 0 else 0,
+                    stop_loss=current_price * 0.97,   # 3%止损
+                    take_profit=current_price * 1.08  # 8%止盈
+                )
                 buy_count += 1
                 log.info(f"  买入成功，金额: {position_value:.0f}")
             else:
@@ -835,48 +990,114 @@ def trade_logic(context):
     log.info(f"操作后可用资金: {context.portfolio.available_cash:.2f}")
 
 # ==================== 辅助函数 ====================
+PENDING_STATUSES = frozenset({'open', 'pending'})  # 开盘需撤销的订单状态
+# 代码前两位 -> 收盘涨停判定阈值(%)：科创板、创业板20%，主板10%
+LIMIT_UP_PCT = {'68': 19.9, '30': 19.9, '00': 9.9, '60': 9.9}
+
+def screen_basic_candidates(current_date, prev_date):
+    """
+    基础筛选：涨幅、换手率、非收盘涨停
+    全池行情一次批量获取，按成本从低到高逐级过滤，流通股本只查询涨幅达标的股票
+    """
+    try:
+        codes = [code for code, _ in g.stock_list]
+        if not codes:
+            return []
+        names = dict(g.stock_list)
+    
+        price_panel = get_price(codes, end_date=current_date, count=2,
+                                fields=['close', 'high', 'volume', 'low'], panel=False)
+        if price_panel is None or price_panel.empty:
+            return []
+    
+        # 长表转宽表（行=日期，列=股票），保持股票池顺序
+        wide = price_panel.pivot(index='time', columns='code')
+        closes = wide['close'].reindex(columns=codes)
+        if len(closes) < 2:
+            return []
+    
+        # 1. 先用最便宜的涨幅条件过滤（缺少行情的股票为NaN，比较结果为False）
+        pre_close = closes.iloc[0]
+        today_high = wide['high'].reindex(columns=codes).iloc[1]
+        price_change = (today_high - pre_close) / pre_close * 100
+        price_change = price_change[price_change > g.params['min_price_change']]
+        if price_change.empty:
+            return []
+    
+        # 2. 仅对涨幅达标的股票查询流通股本、计算换手率
+        survivors = price_change.index.tolist()
+        today_volume = wide['volume'].reindex(columns=survivors).iloc[1]
+        circ_df = get_fundamentals(
+            query(valuation.code, valuation.circulating_cap).filter(valuation.code.in_(survivors)),
+            date=prev_date
+        )
+        if circ_df is None or circ_df.empty:
+            return []
+        circ_df = circ_df.set_index('code')
+        circulating_shares = circ_df['circulating_cap'].reindex(survivors) * 10000
+        turnover_ratio = today_volume / circulating_shares * 100
+    
+        # 3. 换手率达标后再排除收盘涨停
+        screen = pd.DataFrame({'price_change': price_change, 'turnover_ratio': turnover_ratio})
+        screen = screen[(screen['turnover_ratio'] > g.params['min_turnover']) &
+                        (screen['turnover_ratio'] <= g.params['max_turnover'])]
+        limit_up = limit_up_mask(screen.index, pre_close[screen.index],
+                                 closes.iloc[1][screen.index])
+        passed = screen[~limit_up]
+    
+        basic_candidates = []
+        for stock_code, row in passed.iterrows():
+            basic_candidates.append({
+                'code': stock_code,
+                'name': names[stock_code],
+                'price_change': row['price_change'],
+                'turnover_ratio': row['turnover_ratio']
+            })
+        return basic_candidates
+    except Exception as e:
+        log.error(f"基础筛选失败: {str(e)}")
+        return []
+
 def morning_cleanup(context):
     """开盘清理"""
     orders = get_open_orders()
-    canceled_count = 0
-    for order_list in orders.values():
-        for o in order_list:
-            if o.status in ['open', 'pending']:
-                cancel_order(o)
-                canceled_count += 1
+    pending = [o for order_list in orders.values() for o in order_list
+               if o.status in PENDING_STATUSES]
+    for o in pending:
+        cancel_order(o)
+    canceled_count = len(pending)
     
     if canceled_count > 0:
-        log.info(f"取消 {canceled_count} 个未成交订单")
-    
-    stocks_to_remove = []
-    for stock_code, position in list(g.positions.items()):
-        if position.get('selling', False):
-            stocks_to_remove.append(stock_code)
+        log.info("取消 %d 个未成交订单", canceled_count)
     
-    for stock_code in stocks_to_remove:
-        if stock_code in g.positions:
-            del g.positions[stock_code]
+    # 移除所有已标记卖出的持仓记录（按掩码整体压缩列数组）
+    keep = ~g.selling
+    g.codes = [code for code, k in zip(g.codes, keep) if k]
+    g.buy_prices = g.buy_prices[keep]
+    g.selling = g.selling[keep]
+    g.code_idx = {code: i for i, code in enumerate(g.codes)}
+    g.positions = {code: g.positions[code] for code in g.codes}
     
-    log.info(f"交易日: {context.current_dt.date()}")
-    log.info(f"开盘资金 - 可用: {context.portfolio.available_cash:.2f}, 总资产: {context.portfolio.total_value:.2f}")
-    log.info(f"当前持仓数: {len(g.positions)}")
+    log.info("交易日: %s", context.current_dt.date())
+    log.info("开盘资金 - 可用: %.2f, 总资产: %.2f",
+             context.portfolio.available_cash, context.portfolio.total_value)
+    log.info("当前持仓数: %d", len(g.positions))
 
-def is_close_limit_up(stock_code, current_date):
-    """判断是否收盘涨停"""
-    try:
-        price_data = get_price(stock_code, end_date=current_date, count=2, fields=['close'])
-        if len(price_data) < 2:
-            return False
-        pre_close = price_data['close'].iloc[0]
-        today_close = price_data['close'].iloc[1]
-        change_pct = (today_close - pre_close) / pre_close * 100
-        if stock_code.startswith('68') or stock_code.startswith('30'):
-            return change_pct >= 19.9
-        elif stock_code.startswith('00') or stock_code.startswith('60'):
-            return change_pct >= 9.9
-        return False
-    except:
-        return False
+@lru_cache(maxsize=64)
+def prev_trade_day(current_date):
+    """前一交易日（按日期缓存），无法确定时返回None"""
+    trade_days = get_trade_days(end_date=current_date, count=2)
+    return trade_days[0] if len(trade_days) >= 2 else None
+
+def limit_up_mask(codes, pre_close, today_close):
+    """
+    向量化判断收盘涨停，返回与 today_close 对齐的布尔序列
+    阈值按代码前两位查 LIMIT_UP_PCT
+    """
+    change_pct = (today_close - pre_close) / pre_close.where(pre_close > 0) * 100  # 昨收无效时为NaN，不判涨停
+    # 不在表中的板块阈值为NaN，比较结果为False
+    thresholds = pd.Index(codes).str[:2].map(LIMIT_UP_PCT).values.astype(np.float64)
+    return change_pct >= thresholds
 
 def handle_data(context, data):
     """
@@ -887,28 +1108,43 @@ def handle_data(context, data):
     if not g.trading_enabled:
         return
     
-    current_time = context.current_dt.time()
+    dt = context.current_dt
+    minute_of_day = dt.hour * 60 + dt.minute
     
     # 可以添加时间过滤，避免在某些时段检查
     # 例如：避免在开盘集合竞价和尾盘检查（尾盘有专门函数）
-    if current_time.hour == 9 and current_time.minute < 30:  # 开盘集合竞价
+    if minute_of_day < OPEN_CUTOFF:  # 开盘集合竞价
         return
-    if current_time.hour == 14 and current_time.minute >= 55:  # 尾盘交给专门函数
+    if minute_of_day >= CLOSE_CUTOFF:  # 尾盘交给专门函数
         return
     
+    # 空仓时无需检查止损止盈，也没有待清理的卖出记录
+    if not g.positions:
+        return
+    
+    # 本分钟统一获取一次行情快照，供下游检查只读使用
+    current_data = get_current_data()
+    
     # 调用立即止损止盈检查
-    check_immediate_stops(context)
+    check_immediate_stops(context, current_data)
     
     # 可选：每分钟清理已卖出的持仓记录
     cleanup_sold_positions(context)
 def after_trading_end(context):
     """盘后总结"""
-    log.info(f"交易日结束总结:")
-    log.info(f"持仓数量: {len(g.positions)}")
-    for stock_code, position in g.positions.items():
-        try:
-            current_price = get_current_data()[stock_code].last_price
-            profit_pct = (current_price - position['buy_price']) / position['buy_price'] * 100
-            log.info(f"  {stock_code}: 成本 {position['buy_price']:.2f} | 现价 {current_price:.2f} | 盈亏 {profit_pct:+.1f}%")
-        except:
-            continue
+    log.info("交易日结束总结:")
+    log.info("持仓数量: %d", len(g.positions))
+    codes = list(g.positions)
+    if not codes:
+        return
+    buy_prices, current_prices, profit_pcts = position_profit_arrays(codes, get_current_data())
+    # 读取行情失败的持仓现价为NaN，不列入总结
+    valid = ~np.isnan(current_prices)
+    if not valid.any():
+        return
+    codes = [code for code, ok in zip(codes, valid) if ok]
+    buy_prices, current_prices, profit_pcts = buy_prices[valid], current_prices[valid], profit_pcts[valid]
+    # 模板与参数分开传入，格式化推迟到日志实际输出时
+    line = "  %s: 成本 %.2f | 现价 %.2f | 盈亏 %+.1f%%"
+    args = [v for row in zip(codes, buy_prices, current_prices, profit_pcts) for v in row]
+    log.info("\n".join([line] * len(codes)), *args)